@@ -3,14 +3,38 @@ SNOUTIQ Flask API
 Production-ready veterinary symptom checker API
 """
 
-from flask import Flask, request, jsonify
-from flask_cors import CORS
-from rag_system import SnoutiqRAG
 import os
+
+# Pin OpenMP/MKL threads per process before faiss/torch load (2 workers x 4 threads on 8 vCPUs)
+NUM_THREADS = int(os.environ.setdefault('OMP_NUM_THREADS', '4'))
+os.environ.setdefault('MKL_NUM_THREADS', str(NUM_THREADS))
+# The master tokenizes while building the index; its Rust thread pool isn't fork-safe
+os.environ.setdefault('TOKENIZERS_PARALLELISM', 'false')
+
+from flask import Flask, Response, request, stream_with_context
+from flask_cors import CORS
+import faiss
+import torch
+from rag_system import (
+    SnoutiqRAG, EMBEDDING_MODEL, INDEX_FACTORIES, SEVERITY_BOOST, SPECIES_IDS, UNKNOWN_SPECIES_ID,
+    NEAR_DUPLICATE_THRESHOLD, NEAR_DUPLICATE_NEIGHBORS, NEAR_DUPLICATE_MAX_ENTRIES
+)
 from dotenv import load_dotenv
 import logging
-from typing import Dict, Any
+from typing import Dict, Any, List
 import glob
+import atexit
+import hashlib
+import orjson
+
+
+def configure_threads(num_threads: int = NUM_THREADS) -> None:
+    """Set the FAISS (OpenMP) and PyTorch intra-op thread counts for this process"""
+    faiss.omp_set_num_threads(num_threads)
+    torch.set_num_threads(num_threads)
+
+
+configure_threads()
 
 # Load environment variables
 load_dotenv()
@@ -29,6 +53,14 @@ CORS(app)  # Enable CORS for frontend access
 # Global RAG system instance
 rag_system = None
 
+# On-disk cache location (vector index + LLM response cache)
+CACHE_DIR = os.path.join(os.path.dirname(__file__), 'datasets', '.cache')
+
+
+def ojsonify(obj: Any, status: int = 200):
+    """Serialize obj with orjson into a JSON response"""
+    return app.response_class(orjson.dumps(obj), mimetype='application/json'), status
+
 
 def validate_pet_details(data: Dict[str, Any]) -> tuple[bool, str]:
     """Validate pet details from request"""
@@ -53,6 +85,32 @@ def validate_pet_details(data: Dict[str, Any]) -> tuple[bool, str]:
     return True, ""
 
 
+def dataset_signature(dataset_files: List[str], embedder_variant: str) -> str:
+    """Hash dataset paths, mtimes and sizes (plus encoder and index settings) into a cache key"""
+    near_duplicates = f"{NEAR_DUPLICATE_THRESHOLD}:{NEAR_DUPLICATE_NEIGHBORS}:{NEAR_DUPLICATE_MAX_ENTRIES}"
+    # Species ids are persisted with the index; severity boosts also decide which near-duplicate survives
+    entry_settings = f"{sorted(SPECIES_IDS.items())}:{UNKNOWN_SPECIES_ID}:{sorted(SEVERITY_BOOST.items())}"
+    parts = [
+        f"{EMBEDDING_MODEL}:{embedder_variant}:{INDEX_FACTORIES}:{near_duplicates}:{entry_settings}".encode()
+    ]
+    for path in sorted(dataset_files):
+        stat = os.stat(path)
+        parts.append(f"{path}:{stat.st_mtime_ns}:{stat.st_size}".encode())
+    return hashlib.sha256(b"".join(parts)).hexdigest()[:16]
+
+
+def remove_stale_caches(signature: str) -> None:
+    """Delete index and LLM cache files left behind by other dataset signatures"""
+    for path in glob.glob(os.path.join(CACHE_DIR, 'index_*')) + glob.glob(os.path.join(CACHE_DIR, 'llm_cache_*')):
+        # index_<sig>.faiss, llm_cache_<sig>.pkl, llm_cache_<sig>.<pid>.pkl (and .tmp files)
+        if os.path.basename(path).rpartition('_')[2].split('.')[0] == signature:
+            continue
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.warning(f"⚠ Could not remove stale cache file {path}: {e}")
+
+
 def initialize_rag_system():
     """Initialize the RAG system with datasets"""
     global rag_system
@@ -76,10 +134,24 @@ def initialize_rag_system():
 
     logger.info(f"Found {len(dataset_files)} dataset files")
 
-    success = rag_system.load_datasets(dataset_files)
+    # Reuse the persisted index when the datasets haven't changed
+    signature = dataset_signature(dataset_files, rag_system.embedder_variant)
+    index_path = os.path.join(CACHE_DIR, f"index_{signature}")
 
-    if not success:
-        raise RuntimeError("Failed to load datasets")
+    if not rag_system.load_index(index_path):
+        success = rag_system.load_datasets(dataset_files)
+
+        if not success:
+            raise RuntimeError("Failed to load datasets")
+
+        if rag_system.save_index(index_path):
+            remove_stale_caches(signature)
+
+    # Restore cached LLM responses and persist them again on shutdown. The
+    # cache stores document positions, so it is tied to the index signature.
+    llm_cache_path = os.path.join(CACHE_DIR, f"llm_cache_{signature}")
+    rag_system.load_cache(llm_cache_path)
+    atexit.register(rag_system.save_cache, llm_cache_path)
 
     logger.info("✅ RAG System initialized successfully")
 
@@ -87,11 +159,57 @@ def initialize_rag_system():
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    return jsonify({
+    return ojsonify({
         'status': 'healthy',
         'service': 'SNOUTIQ API',
         'rag_loaded': rag_system is not None and rag_system.loaded
-    }), 200
+    }, 200)
+
+
+def parse_query_request():
+    """Validate a query request; returns (pet_details, query, None) or (None, None, error response)"""
+    # Check if RAG system is initialized
+    if rag_system is None or not rag_system.loaded:
+        return None, None, ojsonify({
+            'success': False,
+            'error': 'RAG system not initialized'
+        }, 503)
+
+    # Get request data
+    try:
+        data = orjson.loads(request.get_data())
+    except orjson.JSONDecodeError:
+        data = None
+
+    if not data:
+        return None, None, ojsonify({
+            'success': False,
+            'error': 'No JSON data provided'
+        }, 400)
+
+    # Validate required fields
+    is_valid, error_msg = validate_pet_details(data)
+    if not is_valid:
+        return None, None, ojsonify({
+            'success': False,
+            'error': error_msg
+        }, 400)
+
+    # Build pet details
+    pet_details = {
+        'name': data['name'].strip(),
+        'species': data['species'].strip(),
+        'breed': data.get('breed', 'Mixed').strip(),
+        'age': data.get('age', 'Unknown').strip(),
+        'weight': data.get('weight', 'Unknown').strip(),
+        'sex': data.get('sex', 'Unknown').strip(),
+        'vaccination_summary': data.get('vaccination_summary', 'Not provided').strip(),
+        'medical_history': data.get('medical_history', 'No history provided').strip()
+    }
+
+    query = data['query'].strip()
+
+    return pet_details, query, None
 
 
 @app.route('/query', methods=['POST'])
@@ -119,43 +237,9 @@ def process_query():
     }
     """
     try:
-        # Check if RAG system is initialized
-        if rag_system is None or not rag_system.loaded:
-            return jsonify({
-                'success': False,
-                'error': 'RAG system not initialized'
-            }), 503
-
-        # Get request data
-        data = request.get_json()
-
-        if not data:
-            return jsonify({
-                'success': False,
-                'error': 'No JSON data provided'
-            }), 400
-
-        # Validate required fields
-        is_valid, error_msg = validate_pet_details(data)
-        if not is_valid:
-            return jsonify({
-                'success': False,
-                'error': error_msg
-            }), 400
-
-        # Build pet details
-        pet_details = {
-            'name': data['name'].strip(),
-            'species': data['species'].strip(),
-            'breed': data.get('breed', 'Mixed').strip(),
-            'age': data.get('age', 'Unknown').strip(),
-            'weight': data.get('weight', 'Unknown').strip(),
-            'sex': data.get('sex', 'Unknown').strip(),
-            'vaccination_summary': data.get('vaccination_summary', 'Not provided').strip(),
-            'medical_history': data.get('medical_history', 'No history provided').strip()
-        }
-
-        query = data['query'].strip()
+        pet_details, query, error = parse_query_request()
+        if error:
+            return error
 
         # Log request
         logger.info(f"Processing query for {pet_details['name']} ({pet_details['species']})")
@@ -164,71 +248,101 @@ def process_query():
         response = rag_system.process_query(pet_details, query)
 
         # Return response
-        return jsonify({
+        return ojsonify({
             'success': True,
             'data': response
-        }), 200
+        }, 200)
+
+    except Exception as e:
+        logger.error(f"Error processing query: {str(e)}", exc_info=True)
+        return ojsonify({
+            'success': False,
+            'error': 'Internal server error',
+            'message': str(e)
+        }, 500)
+
+
+@app.route('/query/stream', methods=['POST'])
+def process_query_stream():
+    """
+    Streaming endpoint: same request body as /query
+
+    Response: newline-delimited JSON (application/x-ndjson), one event per line
+    {"delta": "..."}                  raw LLM text as Gemini generates it
+    {"done": true, "data": { ... response object ... }, "query_metadata": { ... }}
+
+    The "done" event always comes last, with the fallback response if the LLM
+    fails mid-stream. Emergencies and cached answers send only that event.
+    """
+    try:
+        pet_details, query, error = parse_query_request()
+        if error:
+            return error
+
+        logger.info(f"Streaming query for {pet_details['name']} ({pet_details['species']})")
+
+        # Search runs here, so its errors still get a 500 instead of a broken stream
+        events = rag_system.process_query_stream(pet_details, query)
+
+        return Response(
+            stream_with_context(orjson.dumps(event) + b'\n' for event in events),
+            mimetype='application/x-ndjson',
+            headers={'X-Accel-Buffering': 'no'}  # don't let nginx buffer the stream
+        )
 
     except Exception as e:
         logger.error(f"Error processing query: {str(e)}", exc_info=True)
-        return jsonify({
+        return ojsonify({
             'success': False,
             'error': 'Internal server error',
             'message': str(e)
-        }), 500
+        }, 500)
 
 
 @app.route('/datasets/info', methods=['GET'])
 def dataset_info():
     """Get information about loaded datasets"""
     if rag_system is None or not rag_system.loaded:
-        return jsonify({
+        return ojsonify({
             'success': False,
             'error': 'RAG system not initialized'
-        }), 503
+        }, 503)
 
-    return jsonify({
+    return ojsonify({
         'success': True,
         'data': {
             'total_entries': len(rag_system.documents),
             'embedding_model': 'all-MiniLM-L6-v2',
             'llm_model': 'gemini-2.0-flash'
         }
-    }), 200
+    }, 200)
 
 
 @app.errorhandler(404)
 def not_found(error):
     """Handle 404 errors"""
-    return jsonify({
+    return ojsonify({
         'success': False,
         'error': 'Endpoint not found'
-    }), 404
+    }, 404)
 
 
 @app.errorhandler(500)
 def internal_error(error):
     """Handle 500 errors"""
     logger.error(f"Internal server error: {str(error)}")
-    return jsonify({
+    return ojsonify({
         'success': False,
         'error': 'Internal server error'
-    }), 500
-
-
-# Initialize RAG system on module import (works with both gunicorn and direct run)
-try:
-    logger.info("🚀 Initializing SNOUTIQ RAG System...")
-    initialize_rag_system()
-    logger.info("✅ RAG System initialization complete")
-except Exception as e:
-    logger.error(f"❌ Failed to initialize RAG system: {str(e)}", exc_info=True)
-    # Don't exit - let the server start so we can see health endpoint
+    }, 500)
 
 
 if __name__ == '__main__':
     try:
-        # Start Flask server (only when run directly, not with gunicorn)
+        # Development server only; production runs gunicorn against wsgi:app
+        initialize_rag_system()
+        rag_system.warmup()
+
         port = int(os.getenv('PORT', 5000))
         debug = os.getenv('FLASK_ENV') == 'development'
 
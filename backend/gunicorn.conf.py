@@ -0,0 +1,22 @@
+"""
+SNOUTIQ gunicorn settings
+Loaded automatically by gunicorn from the working directory
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def post_worker_init(worker):
+    """Warm up each worker's own encoder, batcher and index before it takes requests"""
+    import app
+
+    if app.rag_system is None or not app.rag_system.loaded:
+        return
+
+    try:
+        app.rag_system.warmup()
+        logger.info(f"✅ Worker {worker.pid} warmed up")
+    except Exception as e:
+        logger.error(f"❌ Worker {worker.pid} warmup failed: {str(e)}", exc_info=True)
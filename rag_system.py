@@ -3,16 +3,43 @@ SNOUTIQ RAG System - Core Module
 Veterinary symptom checker using RAG (Retrieval-Augmented Generation)
 """
 
-import json
+import orjson
+import hashlib
 import numpy as np
 import faiss
 from sentence_transformers import SentenceTransformer
 import google.generativeai as genai
-from typing import Dict, List, Any
-import re
+from google.api_core import retry
+import torch
+import ahocorasick
+from typing import Dict, List, Any, Iterator, Callable
+import os
+import copy
+import glob
+import time
+import queue
+import pickle
+import tempfile
+import threading
+from concurrent.futures import Future
 from datetime import datetime
 import logging
 
+try:
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    import onnxruntime
+    from transformers import AutoTokenizer
+    ONNX_AVAILABLE = True
+except ImportError:
+    ONNX_AVAILABLE = False
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -20,11 +47,62 @@ logger = logging.getLogger(__name__)
 # ==================== CONFIGURATION ====================
 EMBEDDING_MODEL = "all-MiniLM-L6-v2"
 GEMINI_MODEL = "gemini-2.0-flash"
+LLM_TIMEOUT = 30  # seconds per Gemini call, retries included
+
+# ONNX Runtime int8 export of the embedding model
+ONNX_MODEL_ID = f"sentence-transformers/{EMBEDDING_MODEL}"
+ONNX_MODEL_DIR = os.getenv(
+    'ONNX_MODEL_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models', f"{EMBEDDING_MODEL}-onnx-int8")
+)
+ONNX_MODEL_FILE = "model_quantized.onnx"
+ONNX_QUANTIZATION = {'is_static': False, 'per_channel': False}  # dynamic avx512_vnni int8
+MAX_SEQ_LENGTH = 256
 
 # Search parameters
 TOP_K = 10
 MIN_SIMILARITY = 0.3
 SEVERITY_BOOST = {"emergency": 1.5, "urgent": 1.2, "routine": 1.0}
+SPECIES_IDS = {"dogs": 0, "cats": 1}
+UNKNOWN_SPECIES_ID = 2
+
+# Entries of the same species above this cosine similarity are pruned as near-duplicates
+NEAR_DUPLICATE_THRESHOLD = 0.98
+NEAR_DUPLICATE_NEIGHBORS = 8  # nearest neighbours checked per entry (cross-species hits included)
+NEAR_DUPLICATE_MAX_ENTRIES = 50_000  # the exact all-pairs search is skipped above this
+
+# Entry fields kept (as columns) for building responses
+METADATA_FIELDS = (
+    'symptom', 'description', 'severity', 'home_care_india', 'vet_triggers',
+    'service_recommendation', 'indian_climate_factors', 'category'
+)
+
+# Vector index parameters: (max entries, FAISS factory string), chosen by corpus size
+INDEX_FACTORIES = (
+    (10_000, "Flat"),  # exact scan is fastest at this size
+    (1_000_000, "HNSW32,SQ8"),  # HNSW graph over 8-bit scalar-quantized vectors
+    (None, "IVF4096,PQ48"),  # inverted lists over product-quantized codes
+)
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+IVF_NPROBE = 16
+RERANK_FACTOR = 4  # candidates per result for filtering/boosting (HNSW/IVF: re-scored with FP32 vectors)
+
+# Steps shown when an emergency is answered from the static template. Keep them
+# condition-neutral: first aid differs by emergency (e.g. heat stroke vs. bleeding).
+EMERGENCY_STEPS = (
+    "Go to the nearest veterinary clinic now",
+    "Call the clinic on the way so they can prepare for your pet"
+)
+
+# Query embedding micro-batching
+EMBED_BATCH_SIZE = 32
+EMBED_BATCH_WAIT = 0.005  # seconds to wait for more queries before encoding
+
+# Semantic LLM response cache
+LLM_CACHE_THRESHOLD = 0.93
+LLM_CACHE_CANDIDATES = 5
+LLM_CACHE_MAX_ENTRIES = 10_000  # oldest entries are evicted beyond this
 
 # Medical synonyms for query expansion
 MEDICAL_SYNONYMS = {
@@ -47,6 +125,299 @@ EMERGENCY_KEYWORDS = [
     'snake bite', 'broken bone', 'can\'t stand', 'blue gums'
 ]
 
+# A keyword right after one of these words doesn't count ("not bleeding anymore")
+EMERGENCY_NEGATIONS = frozenset({'no', 'not', 'never', "isn't", "wasn't", "doesn't", "didn't", 'stopped'})
+
+
+def _extract_json(text: str) -> str | None:
+    """Return the first balanced {...} object in text (linear scan, string-aware)"""
+    start = text.find('{')
+    if start == -1:
+        return None
+
+    depth = 0
+    in_string = False
+    escape = False
+    for i in range(start, len(text)):
+        char = text[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif char == '\\':
+                escape = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+
+    return None
+
+
+def _rank_candidates_loop(indices, scores, species_ids, boost, wanted_species, min_similarity, top_k):
+    """Filter candidates by similarity/species, apply severity boost, return top_k (Numba kernel)"""
+    n = indices.shape[0]
+    kept = np.empty(n, dtype=np.int64)
+    boosted = np.empty(n, dtype=np.float32)
+    count = 0
+    for i in range(n):
+        idx = indices[i]
+        if scores[i] < min_similarity:
+            continue
+        if wanted_species >= 0 and species_ids[idx] != wanted_species:
+            continue
+        kept[count] = idx
+        boosted[count] = scores[i] * boost[idx]
+        count += 1
+
+    kept = kept[:count]
+    boosted = boosted[:count]
+    order = np.argsort(-boosted, kind='mergesort')[:top_k]
+    return kept[order], boosted[order]
+
+
+def _rank_candidates_numpy(indices, scores, species_ids, boost, wanted_species, min_similarity, top_k):
+    """Filter candidates by similarity/species, apply severity boost, return top_k (NumPy)"""
+    mask = scores >= min_similarity
+    if wanted_species >= 0:
+        mask &= species_ids[indices] == wanted_species
+    indices = indices[mask]
+
+    boosted = scores[mask] * boost[indices]
+    order = np.argsort(-boosted, kind='stable')[:top_k]
+    return indices[order], boosted[order]
+
+
+def _compile_rank_candidates():
+    """JIT the ranking kernel with Numba, falling back to NumPy"""
+    if not NUMBA_AVAILABLE:
+        return _rank_candidates_numpy
+
+    try:
+        return njit(cache=True)(_rank_candidates_loop)
+    except Exception as e:
+        # cache=True raises at decoration when no cache directory is writable
+        logger.warning(f"⚠ Numba kernel cache unavailable, using NumPy ranking: {e}")
+        return _rank_candidates_numpy
+
+
+rank_candidates = _compile_rank_candidates()
+
+
+def choose_index_factory(num_entries: int) -> str:
+    """Pick the FAISS index factory string for a corpus of num_entries vectors"""
+    for max_entries, factory in INDEX_FACTORIES:
+        if max_entries is None or num_entries < max_entries:
+            return factory
+
+
+def index_is_exact(index: faiss.Index) -> bool:
+    """Whether search scores are already exact inner products (no FP32 re-rank needed)"""
+    return isinstance(index, faiss.IndexFlat)
+
+
+def configure_index_search(index: faiss.Index) -> None:
+    """Apply query-time parameters for HNSW / IVF indexes"""
+    if hasattr(index, 'hnsw'):
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = IVF_NPROBE
+
+
+class OnnxEmbedder:
+    """int8-quantized ONNX Runtime sentence encoder (drop-in for SentenceTransformer.encode)"""
+
+    def __init__(self, model_id: str = ONNX_MODEL_ID, model_dir: str = ONNX_MODEL_DIR):
+        """Load the quantized model, exporting and quantizing it on first use"""
+        if not os.path.exists(os.path.join(model_dir, ONNX_MODEL_FILE)):
+            logger.info(f"🔄 Exporting {model_id} to int8 ONNX...")
+            model = ORTModelForFeatureExtraction.from_pretrained(
+                model_id, export=True, provider="CPUExecutionProvider"
+            )
+            quantizer = ORTQuantizer.from_pretrained(model)
+            quantizer.quantize(
+                save_dir=model_dir,
+                quantization_config=AutoQuantizationConfig.avx512_vnni(**ONNX_QUANTIZATION)
+            )
+            AutoTokenizer.from_pretrained(model_id).save_pretrained(model_dir)
+
+        # Match ONNX Runtime's thread pool to the process's OpenMP setting (0 = all cores)
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = int(os.getenv('OMP_NUM_THREADS', '0'))
+
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_dir,
+            file_name=ONNX_MODEL_FILE,
+            provider="CPUExecutionProvider",
+            session_options=session_options
+        )
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+
+    def get_sentence_embedding_dimension(self) -> int:
+        """Embedding vector size"""
+        return self.model.config.hidden_size
+
+    def encode(
+        self,
+        sentences: List[str],
+        batch_size: int = 32,
+        normalize_embeddings: bool = True,
+        **kwargs
+    ) -> np.ndarray:
+        """Encode sentences with mean pooling (and optional L2 normalization)"""
+        batches = []
+        for start in range(0, len(sentences), batch_size):
+            inputs = self.tokenizer(
+                sentences[start:start + batch_size],
+                padding=True,
+                truncation=True,
+                max_length=MAX_SEQ_LENGTH,
+                return_tensors='np'
+            )
+            token_embeddings = self.model(**inputs).last_hidden_state
+
+            # Mean pooling over non-padding tokens
+            mask = inputs['attention_mask'][..., None].astype('float32')
+            pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+            if normalize_embeddings:
+                pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+
+            batches.append(pooled.astype('float32', copy=False))
+
+        return batches[0] if len(batches) == 1 else np.concatenate(batches)
+
+
+def load_embedder(kind: str = None) -> tuple:
+    """Load the ONNX int8 encoder, falling back to PyTorch SentenceTransformer
+
+    Returns (embedder, kind) with kind 'onnx' or 'torch'. Passing kind pins the
+    backend, so every process encodes queries like the one that built the index."""
+    if ONNX_AVAILABLE and kind in (None, 'onnx'):
+        try:
+            return OnnxEmbedder(), 'onnx'
+        except Exception as e:
+            if kind == 'onnx':
+                raise
+            logger.warning(f"⚠ ONNX encoder unavailable, using PyTorch: {e}")
+    elif kind == 'onnx':
+        raise RuntimeError("ONNX encoder required but optimum/onnxruntime is not installed")
+
+    if 'OMP_NUM_THREADS' not in os.environ:
+        torch.set_num_threads(os.cpu_count() or 1)
+    embedder = SentenceTransformer(EMBEDDING_MODEL)
+    optimize_torch_embedder(embedder)
+    return embedder, 'torch'
+
+
+def optimize_torch_embedder(embedder: SentenceTransformer) -> None:
+    """Fuse attention with BetterTransformer and compile the transformer, then warm it up"""
+    transformer = embedder[0]
+
+    # Fused attention kernels must match eager outputs on a padded batch, which
+    # a single-sentence check would not exercise
+    check_batch = ["vomiting", "my dog has been vomiting since morning and won't eat"]
+    expected = embedder.encode(check_batch)
+
+    eager_model = transformer.auto_model
+    try:
+        from optimum.bettertransformer import BetterTransformer
+        transformer.auto_model = BetterTransformer.transform(eager_model, keep_original_model=True)
+        if not np.allclose(embedder.encode(check_batch), expected, atol=1e-4):
+            raise ValueError("outputs differ from the eager model on a padded batch")
+    except Exception as e:
+        logger.warning(f"⚠ BetterTransformer unavailable: {e}")
+        transformer.auto_model = eager_model
+
+    # torch.compile traces lazily, so the check encode surfaces any compile failure
+    uncompiled_model = transformer.auto_model
+    try:
+        transformer.auto_model = torch.compile(uncompiled_model, mode="reduce-overhead", dynamic=True)
+        if not np.allclose(embedder.encode(check_batch), expected, atol=1e-4):
+            raise ValueError("outputs differ from the eager model on a padded batch")
+    except Exception as e:
+        logger.warning(f"⚠ torch.compile failed, using eager model: {e}")
+        transformer.auto_model = uncompiled_model
+
+
+class EmbedBatcher:
+    """Coalesces concurrent single-query encodes into batched encoder calls"""
+
+    def __init__(
+        self,
+        get_embedder: Callable[[], Any],
+        max_batch_size: int = EMBED_BATCH_SIZE,
+        max_wait: float = EMBED_BATCH_WAIT
+    ):
+        self.get_embedder = get_embedder  # resolved per batch (the encoder is per process)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_worker(self) -> None:
+        """Start the batching thread (threads don't survive a gunicorn fork)"""
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                threading.Thread(
+                    target=self._run, args=(self._queue,), name='embed-batcher', daemon=True
+                ).start()
+                self._pid = os.getpid()
+
+    def submit(self, text: str) -> Future:
+        """Queue a text for encoding; the future resolves to its normalized embedding"""
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((text, future))
+        return future
+
+    def encode(self, text: str) -> np.ndarray:
+        """Encode a single text, blocking until its batch is done"""
+        return self.submit(text).result()
+
+    def _run(self, pending: queue.Queue) -> None:
+        """Drain up to max_batch_size items or max_wait seconds, then encode them together"""
+        while True:
+            items = [pending.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(items) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    items.append(pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                embeddings = self.get_embedder().encode(
+                    [text for text, _ in items],
+                    batch_size=self.max_batch_size,
+                    normalize_embeddings=True,
+                    convert_to_numpy=True,
+                    convert_to_tensor=False,
+                    output_value='sentence_embedding'
+                )
+            except Exception as e:
+                for _, future in items:
+                    future.set_exception(e)
+                continue
+
+            for (_, future), embedding in zip(items, embeddings):
+                future.set_result(embedding)
+
 
 class SnoutiqRAG:
     """SNOUTIQ RAG System for veterinary symptom analysis"""
@@ -55,31 +426,81 @@ class SnoutiqRAG:
         """Initialize the RAG system with API key"""
         logger.info("📊 Loading AI models...")
 
-        # Load embedding model
-        self.embedder = SentenceTransformer(EMBEDDING_MODEL)
+        # Load embedding model (reloaded lazily in each forked worker, see `embedder`)
+        self._embedders: Dict[int, Any] = {}  # pid -> encoder
+        self._embedder_lock = threading.Lock()
+        self.embedder_kind = None
+        self.batcher = EmbedBatcher(lambda: self.embedder)
+
+        # Single-pass matchers for synonym and emergency terms
+        self.synonym_automaton = self._build_automaton(MEDICAL_SYNONYMS)
+        self.emergency_automaton = self._build_automaton(EMERGENCY_KEYWORDS)
 
         # Configure Gemini
         genai.configure(api_key=api_key)
         self.llm = genai.GenerativeModel(GEMINI_MODEL)
 
         self.documents = []
-        self.metadata = []
+        self.columns: Dict[str, List] = {field: [] for field in METADATA_FIELDS}
         self.index = None
+        self.embeddings = None  # FP32 vectors (memory-mapped) for re-ranking approximate indexes
+        self.species_ids = None  # per-entry species id (int8)
+        self.boost = None  # per-entry severity boost (float32)
+        self._embeddings_file = None
         self.loaded = False
 
+        # Semantic cache of LLM responses
+        self.cache_index = faiss.IndexFlatIP(self.embedder.get_sentence_embedding_dimension())
+        self.cache_entries: List[Dict] = []
+        self._cache_dirty = False  # entries added since the last load/save
+        self._cache_lock = threading.Lock()
+
         logger.info("✅ Models loaded successfully")
 
+    @property
+    def embedder(self):
+        """Encoder owned by the current process
+
+        ONNX Runtime / OpenMP thread pools don't survive fork, so a gunicorn
+        `--preload` worker must not reuse the master's session: each process
+        loads its own, pinned to the backend the index was built with. The
+        inherited encoder is kept, not freed: its destructor would wait on
+        pool threads that don't exist in the child."""
+        pid = os.getpid()
+        if pid not in self._embedders:
+            with self._embedder_lock:
+                if pid not in self._embedders:
+                    self._embedders[pid], self.embedder_kind = load_embedder(self.embedder_kind)
+        return self._embedders[pid]
+
+    @property
+    def embedder_variant(self) -> str:
+        """Encoder class and precision; ONNX int8 and PyTorch FP32 vectors aren't interchangeable"""
+        name = type(self.embedder).__name__
+        if self.embedder_kind == 'onnx':
+            return f"{name}:int8:avx512_vnni:{sorted(ONNX_QUANTIZATION.items())}:{ONNX_MODEL_FILE}"
+        return f"{name}:fp32"
+
+    def warmup(self) -> None:
+        """Load this process's encoder and batcher and touch the index so the first request isn't cold
+
+        Search only: a warmup LLM call would cost money and pollute the cache."""
+        self.search("warmup vomiting")
+
     def load_datasets(self, dataset_files: List[str]) -> bool:
         """Load all dataset files and create embeddings"""
         logger.info("📚 Loading veterinary datasets...")
 
         all_texts = []
-        all_metadata = []
+        columns = {field: [] for field in METADATA_FIELDS}
+        species_ids = []
+        seen = set()
+        num_duplicates = 0
 
         for filename in dataset_files:
             try:
-                with open(filename, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
+                with open(filename, 'rb') as f:
+                    data = orjson.loads(f.read())
 
                 category = filename.replace('master_', '').replace('_dataset.json', '').split('/')[-1]
                 entries = data.get('entries', data if isinstance(data, list) else [])
@@ -87,11 +508,22 @@ class SnoutiqRAG:
                 for entry in entries:
                     # Combine symptom and description for embedding
                     text = f"{entry.get('symptom', '')}. {entry.get('description', '')}"
+                    species_id = SPECIES_IDS.get((entry.get('species') or '').lower(), UNKNOWN_SPECIES_ID)
+
+                    # Skip exact duplicates (same text for the same species)
+                    key = hashlib.blake2b(f"{species_id}|{text}".encode(), digest_size=16).digest()
+                    if key in seen:
+                        num_duplicates += 1
+                        continue
+                    seen.add(key)
+
                     all_texts.append(text)
+                    species_ids.append(species_id)
 
-                    # Store metadata
+                    # Store metadata columns
                     entry['category'] = category
-                    all_metadata.append(entry)
+                    for field in METADATA_FIELDS:
+                        columns[field].append(entry.get(field))
 
                 logger.info(f"   ✓ {category}: {len(entries)} entries")
 
@@ -108,28 +540,194 @@ class SnoutiqRAG:
         embeddings = self.embedder.encode(
             all_texts,
             normalize_embeddings=True,
+            convert_to_numpy=True,
             show_progress_bar=True
         )
 
-        # Build FAISS index
+        # Prune near-duplicates, keeping the most severe entry of each pair
+        keep = self._near_duplicate_mask(embeddings, species_ids, columns['severity'])
+        if not keep.all():
+            kept = np.flatnonzero(keep)
+            embeddings = embeddings[kept]
+            all_texts = [all_texts[i] for i in kept]
+            species_ids = [species_ids[i] for i in kept]
+            columns = {field: [values[i] for i in kept] for field, values in columns.items()}
+
+        if num_duplicates or not keep.all():
+            logger.info(f"   ✂ Dropped {num_duplicates} duplicate and {int((~keep).sum())} near-duplicate entries")
+
+        # Build FAISS index sized to the corpus (inner product = cosine similarity)
+        assert embeddings.dtype == np.float32, f"Unexpected embedding dtype {embeddings.dtype}"
         dimension = embeddings.shape[1]
-        self.index = faiss.IndexFlatIP(dimension)  # Inner product (cosine similarity)
-        self.index.add(embeddings.astype('float32'))
+        factory = choose_index_factory(len(all_texts))
+        logger.info(f"🧭 Building {factory} index")
+        self.index = faiss.index_factory(dimension, factory, faiss.METRIC_INNER_PRODUCT)
+        if hasattr(self.index, 'hnsw'):
+            self.index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        if not self.index.is_trained:
+            self.index.train(embeddings)  # SQ8 ranges / IVF centroids / PQ codebooks
+        self.index.add(embeddings)
+        configure_index_search(self.index)
+
+        # Keep FP32 vectors on disk for exact re-ranking; compressed indexes only hold codes
+        # (a Flat index already stores and scores the FP32 vectors exactly)
+        if self._embeddings_file is not None:
+            self._embeddings_file.close()
+            self._embeddings_file = None
+        self.embeddings = None
+        if not index_is_exact(self.index):
+            self._embeddings_file = tempfile.NamedTemporaryFile(prefix='snoutiq_emb_', suffix='.f32')
+            mapped = np.memmap(self._embeddings_file.name, dtype='float32', mode='w+', shape=embeddings.shape)
+            mapped[:] = embeddings
+            mapped.flush()
+            del mapped
+            self.embeddings = np.memmap(
+                self._embeddings_file.name, dtype='float32', mode='r', shape=embeddings.shape
+            )
+
+        # Per-entry arrays for vectorized filtering and boosting
+        self.species_ids = np.array(species_ids, dtype=np.int8)
+        self.boost = self._severity_boost(columns['severity'])
 
         self.documents = all_texts
-        self.metadata = all_metadata
+        self.columns = columns
         self.loaded = True
 
         logger.info(f"✅ System ready with {len(all_texts)} entries!")
         return True
 
+    @staticmethod
+    def _severity_boost(severities: List[str]) -> np.ndarray:
+        """Per-entry SEVERITY_BOOST multipliers (float32)"""
+        return np.array(
+            [SEVERITY_BOOST.get(severity or 'routine', 1.0) for severity in severities],
+            dtype=np.float32
+        )
+
+    def save_index(self, path: str) -> bool:
+        """Persist the index, metadata columns and (approximate indexes only) FP32 embeddings
+        under `path`; returns success"""
+        extensions = ('faiss', 'npz') if self.embeddings is None else ('faiss', 'npy', 'npz')
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            faiss.write_index(self.index, f"{path}.faiss.tmp")
+            if self.embeddings is not None:
+                with open(f"{path}.npy.tmp", 'wb') as f:
+                    np.save(f, np.asarray(self.embeddings))
+            with open(f"{path}.npz.tmp", 'wb') as f:
+                np.savez(
+                    f,
+                    documents=np.array(self.documents, dtype=object),
+                    species_ids=self.species_ids,
+                    **{field: np.array(values, dtype=object) for field, values in self.columns.items()}
+                )
+
+            for ext in extensions:
+                os.replace(f"{path}.{ext}.tmp", f"{path}.{ext}")
+        except Exception as e:
+            logger.warning(f"⚠ Could not save index cache: {e}")
+            return False
+
+        # Re-rank from the persisted file instead of the temporary one
+        if self.embeddings is not None:
+            self.embeddings = np.load(f"{path}.npy", mmap_mode='r')
+        if self._embeddings_file is not None:
+            self._embeddings_file.close()
+            self._embeddings_file = None
+
+        logger.info(f"💾 Saved index cache to {path}")
+        return True
+
+    def load_index(self, path: str) -> bool:
+        """Load a previously saved index; returns False if no usable cache exists"""
+        if not all(os.path.exists(f"{path}.{ext}") for ext in ('faiss', 'npz')):
+            return False
+
+        try:
+            index = faiss.read_index(f"{path}.faiss")
+            embeddings = None if index_is_exact(index) else np.load(f"{path}.npy", mmap_mode='r')
+            with np.load(f"{path}.npz", allow_pickle=True) as data:
+                documents = data['documents'].tolist()
+                species_ids = data['species_ids']
+                columns = {field: data[field].tolist() for field in METADATA_FIELDS}
+        except Exception as e:
+            logger.warning(f"⚠ Ignoring unreadable index cache: {e}")
+            return False
+
+        if index.ntotal != len(documents) or (embeddings is not None and embeddings.shape[0] != len(documents)):
+            logger.warning("⚠ Ignoring mismatched index cache")
+            return False
+
+        configure_index_search(index)
+        self.index = index
+        self.embeddings = embeddings
+        self.species_ids = species_ids
+        self.boost = self._severity_boost(columns['severity'])  # always from the current SEVERITY_BOOST
+        self.documents = documents
+        self.columns = columns
+        self.loaded = True
+
+        logger.info(f"✅ Loaded cached index with {len(documents)} entries")
+        return True
+
+    def _field(self, idx: int, field: str, default: Any = None) -> Any:
+        """Read one metadata field of entry idx (default if the entry lacks it)"""
+        value = self.columns[field][idx]
+        return default if value is None else value
+
+    @staticmethod
+    def _near_duplicate_mask(
+        embeddings: np.ndarray,
+        species_ids: List[int],
+        severities: List[str]
+    ) -> np.ndarray:
+        """Mask of entries to keep; of each same-species pair above NEAR_DUPLICATE_THRESHOLD
+        only the more severe (or earlier) entry survives"""
+        keep = np.ones(len(embeddings), dtype=bool)
+        if len(embeddings) > NEAR_DUPLICATE_MAX_ENTRIES:
+            logger.info(f"   ⏭ Skipping near-duplicate pruning for {len(embeddings)} entries")
+            return keep
+
+        # Dog and cat versions of an entry are usually each other's nearest
+        # neighbours, so search past them for same-species matches
+        index = faiss.IndexFlatIP(embeddings.shape[1])
+        index.add(embeddings)
+        scores, neighbors = index.search(embeddings, min(NEAR_DUPLICATE_NEIGHBORS, len(embeddings)))
+
+        rank = [SEVERITY_BOOST.get(severity or 'routine', 1.0) for severity in severities]
+        for i in range(len(embeddings)):
+            for score, j in zip(scores[i], neighbors[i]):
+                if score <= NEAR_DUPLICATE_THRESHOLD or not keep[i]:
+                    break  # neighbours come sorted by similarity
+                if j == i or j < 0 or not keep[j] or species_ids[i] != species_ids[j]:
+                    continue
+                # Drop the less severe entry; on ties drop the later one
+                if rank[i] > rank[j] or (rank[i] == rank[j] and i < j):
+                    keep[j] = False
+                else:
+                    keep[i] = False
+
+        return keep
+
+    @staticmethod
+    def _build_automaton(terms) -> ahocorasick.Automaton:
+        """Build an Aho-Corasick automaton that reports each matched term"""
+        automaton = ahocorasick.Automaton()
+        for term in terms:
+            automaton.add_word(term, term)
+        automaton.make_automaton()
+        return automaton
+
     def expand_query(self, query: str) -> str:
         """Expand query with medical synonyms"""
         query_lower = query.lower()
         expanded = [query]
 
+        matched_terms = {term for _, term in self.synonym_automaton.iter(query_lower)}
+
         for term, synonyms in MEDICAL_SYNONYMS.items():
-            if term in query_lower:
+            if term in matched_terms:
                 for syn in synonyms[:2]:
                     if syn not in query_lower:
                         expanded.append(query_lower.replace(term, syn))
@@ -138,8 +736,23 @@ class SnoutiqRAG:
 
     def detect_emergency(self, query: str) -> bool:
         """Detect if query indicates emergency"""
-        query_lower = query.lower()
-        return any(keyword in query_lower for keyword in EMERGENCY_KEYWORDS)
+        # Single scan over emergency keywords, stopping at the first whole-word,
+        # non-negated hit ("blood" must not match "bloodhound" or "bloodwork")
+        text = query.lower()
+        for end, keyword in self.emergency_automaton.iter(text):
+            start = end - len(keyword) + 1
+            if start > 0 and text[start - 1].isalnum():
+                continue
+            if end + 1 < len(text) and text[end + 1].isalnum():
+                continue
+
+            preceding = text[:start].split()
+            if preceding and preceding[-1].strip(',.;:!?') in EMERGENCY_NEGATIONS:
+                continue
+
+            return True
+
+        return False
 
     def search(self, query: str, species: str = None, top_k: int = TOP_K) -> List[Dict]:
         """Search for relevant entries"""
@@ -150,39 +763,163 @@ class SnoutiqRAG:
         expanded_query = self.expand_query(query)
 
         # Get query embedding
-        query_emb = self.embedder.encode([expanded_query], normalize_embeddings=True)
+        # Row view into the batch result: no per-query copy or dtype conversion
+        query_emb = self.batcher.encode(expanded_query)[None, :]
+        assert query_emb.dtype == np.float32, f"Unexpected embedding dtype {query_emb.dtype}"
 
-        # Search
+        # Candidate search (approximate for HNSW/IVF indexes)
         scores, indices = self.index.search(
-            query_emb.astype('float32'),
-            min(top_k * 2, len(self.documents))
+            query_emb,
+            min(top_k * RERANK_FACTOR, len(self.documents))
         )
 
-        # Process results
-        results = []
-        for score, idx in zip(scores[0], indices[0]):
-            if score < MIN_SIMILARITY:
-                continue
+        valid = indices[0] >= 0
+        indices = indices[0][valid]
+        if self.embeddings is None:
+            # Flat index: the search scores already are the exact inner products
+            scores = scores[0][valid]
+        else:
+            # Re-rank candidates with exact FP32 inner products
+            scores = np.dot(query_emb[0], self.embeddings[indices].T)
+
+        # Similarity threshold, species filter and severity boost
+        wanted_species = SPECIES_IDS.get(species.lower(), UNKNOWN_SPECIES_ID) if species else -1
+        indices, boosted = rank_candidates(
+            indices, scores, self.species_ids, self.boost, wanted_species, MIN_SIMILARITY, top_k
+        )
+
+        return [
+            {
+                'score': float(score),
+                'index': int(idx),
+                'text': self.documents[idx]
+            }
+            for idx, score in zip(indices, boosted)
+        ]
+
+    def _cache_key(
+        self,
+        pet_details: Dict[str, Any],
+        query: str,
+        matched_entries: List[Dict]
+    ) -> tuple:
+        """Build the semantic cache key: (query embedding, (pet details hash, top-1 doc id))
+
+        The prompt includes every pet detail, so an answer is only reused for
+        the same pet profile."""
+        top_symptom = self._field(matched_entries[0]['index'], 'symptom', '') if matched_entries else ''
+        vector = self.batcher.encode(f"{query} {top_symptom}")[None, :]
+        pet_hash = hashlib.blake2b(self._pet_summary(pet_details).encode(), digest_size=16).hexdigest()
+        doc_id = matched_entries[0]['index'] if matched_entries else -1
+        return vector, (pet_hash, doc_id)
+
+    def _cache_lookup(self, vector: np.ndarray, scope: tuple) -> Dict | None:
+        """Return a cached LLM result for a near-identical query in the same scope, if any"""
+        with self._cache_lock:
+            if self.cache_index.ntotal == 0:
+                return None
+
+            scores, ids = self.cache_index.search(vector, min(LLM_CACHE_CANDIDATES, self.cache_index.ntotal))
+            for score, cache_id in zip(scores[0], ids[0]):
+                if score <= LLM_CACHE_THRESHOLD:
+                    break
+                entry = self.cache_entries[cache_id]
+                if entry['scope'] == scope:
+                    return copy.deepcopy(entry['result'])
+
+        return None
+
+    def _cache_store(self, vector: np.ndarray, scope: tuple, result: Dict) -> None:
+        """Add a parsed LLM result to the semantic cache, evicting the oldest when full"""
+        with self._cache_lock:
+            self.cache_entries.append({
+                'scope': scope,
+                'vector': vector[0].copy(),
+                'created': time.time(),
+                'result': copy.deepcopy(result)
+            })
+            self._cache_dirty = True
+
+            if len(self.cache_entries) > LLM_CACHE_MAX_ENTRIES:
+                # Drop the oldest 10% at once so the index isn't rebuilt on every store
+                self.cache_entries = self.cache_entries[len(self.cache_entries) - int(LLM_CACHE_MAX_ENTRIES * 0.9):]
+                self._rebuild_cache_index()
+            else:
+                self.cache_index.add(vector)
+
+    def _rebuild_cache_index(self) -> None:
+        """Re-create the cache index from cache_entries (caller holds the lock)"""
+        self.cache_index.reset()
+        if self.cache_entries:
+            self.cache_index.add(np.stack([entry['vector'] for entry in self.cache_entries]))
 
-            meta = self.metadata[idx]
+    def save_cache(self, path: str) -> None:
+        """Persist this process's LLM cache to `path`.<pid>.pkl
 
-            # Species filter
-            if species and meta.get('species', '').lower() != species.lower():
+        Every gunicorn worker writes its own file (merged by load_cache on the
+        next start), and processes that added nothing, like the preloading
+        master, don't write at all."""
+        with self._cache_lock:
+            if not self._cache_dirty:
+                return
+
+            own_path = f"{path}.{os.getpid()}.pkl"
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(f"{own_path}.tmp", 'wb') as f:
+                    pickle.dump(self.cache_entries, f)
+                os.replace(f"{own_path}.tmp", own_path)
+            except Exception as e:
+                logger.warning(f"⚠ Could not save LLM cache: {e}")
+                return
+
+            self._cache_dirty = False
+
+        logger.info(f"💾 Saved {len(self.cache_entries)} cached LLM responses")
+
+    def load_cache(self, path: str) -> None:
+        """Load and merge the saved LLM cache (`path`.pkl plus per-process files)"""
+        files = sorted(glob.glob(f"{glob.escape(path)}.*.pkl"))
+        if os.path.exists(f"{path}.pkl"):
+            files.insert(0, f"{path}.pkl")
+        if not files:
+            return
+
+        # Merge, keeping the newest copy of each (scope, vector) entry
+        merged = {}
+        for filename in files:
+            try:
+                with open(filename, 'rb') as f:
+                    entries = pickle.load(f)
+            except Exception as e:
+                logger.warning(f"⚠ Ignoring unreadable LLM cache {filename}: {e}")
                 continue
 
-            # Apply severity boost
-            severity = meta.get('severity', 'routine')
-            boosted_score = float(score) * SEVERITY_BOOST.get(severity, 1.0)
+            for entry in entries:
+                if entry['vector'].shape[0] != self.cache_index.d:
+                    continue
+                key = (entry['scope'], entry['vector'].tobytes())
+                if key not in merged or merged[key]['created'] < entry['created']:
+                    merged[key] = entry
 
-            results.append({
-                'score': boosted_score,
-                'metadata': meta,
-                'text': self.documents[idx]
-            })
+        cache_entries = sorted(merged.values(), key=lambda entry: entry['created'])[-LLM_CACHE_MAX_ENTRIES:]
 
-        # Sort by boosted score
-        results.sort(key=lambda x: x['score'], reverse=True)
-        return results[:top_k]
+        with self._cache_lock:
+            self.cache_entries = cache_entries
+            self._rebuild_cache_index()
+
+        # Fold the per-process files back into the single merged file
+        try:
+            with open(f"{path}.pkl.tmp", 'wb') as f:
+                pickle.dump(cache_entries, f)
+            os.replace(f"{path}.pkl.tmp", f"{path}.pkl")
+            for filename in files:
+                if filename != f"{path}.pkl":
+                    os.remove(filename)
+        except Exception as e:
+            logger.warning(f"⚠ Could not merge LLM cache files: {e}")
+
+        logger.info(f"✅ Loaded {len(cache_entries)} cached LLM responses")
 
     def generate_response(
         self,
@@ -192,35 +929,74 @@ class SnoutiqRAG:
     ) -> Dict[str, Any]:
         """Generate structured response with pet details"""
 
+        # Detect emergency
+        is_emergency = self.detect_emergency(query)
+
+        # Emergencies skip the LLM: answer immediately from the top match
+        if is_emergency and matched_entries:
+            logger.info("   🚨 Emergency detected, skipping LLM call")
+            return self._create_emergency_response(pet_details, matched_entries)
+
+        prompt = self._build_prompt(pet_details, query, matched_entries, is_emergency)
+
+        try:
+            # Check semantic cache before calling the LLM
+            cache_vector, cache_scope = self._cache_key(pet_details, query, matched_entries)
+            result = self._cache_lookup(cache_vector, cache_scope)
+            cache_hit = result is not None
+
+            if cache_hit:
+                logger.info("   ♻️ Semantic cache hit, skipping LLM call")
+            else:
+                # Generate response
+                response = self.llm.generate_content(prompt, request_options=self._llm_request_options())
+
+                # Extract JSON
+                text = response.text
+                json_text = _extract_json(text)
+
+                if json_text:
+                    result = orjson.loads(json_text)
+                    self._cache_store(cache_vector, cache_scope, result)
+                else:
+                    # Fallback if JSON parsing fails
+                    result = self._create_fallback_response(pet_details, matched_entries, is_emergency)
+
+            # Add metadata
+            result['query_metadata'] = self._query_metadata(matched_entries, is_emergency, cache_hit=cache_hit)
+
+            return result
+
+        except Exception as e:
+            logger.error(f"⚠️ LLM Error: {e}")
+            return self._create_fallback_response(pet_details, matched_entries, is_emergency)
+
+    def _build_prompt(
+        self,
+        pet_details: Dict[str, Any],
+        query: str,
+        matched_entries: List[Dict],
+        is_emergency: bool
+    ) -> str:
+        """Build the LLM prompt from pet details, query and matched entries"""
+
         # Build context from matched entries
         context_parts = []
         for i, entry in enumerate(matched_entries[:3], 1):
-            meta = entry['metadata']
+            idx = entry['index']
             context_parts.append(f"""
 Match {i}:
-  Symptom: {meta.get('symptom', 'N/A')}
-  Description: {meta.get('description', 'N/A')}
-  Severity: {meta.get('severity', 'N/A')}
-  Home Care: {meta.get('home_care_india', 'N/A')}
-  When to See Vet: {meta.get('vet_triggers', 'N/A')}
+  Symptom: {self._field(idx, 'symptom', 'N/A')}
+  Description: {self._field(idx, 'description', 'N/A')}
+  Severity: {self._field(idx, 'severity', 'N/A')}
+  Home Care: {self._field(idx, 'home_care_india', 'N/A')}
+  When to See Vet: {self._field(idx, 'vet_triggers', 'N/A')}
 """)
 
         context = '\n'.join(context_parts)
 
         # Build pet details summary
-        pet_summary = f"""
-Pet Name: {pet_details.get('name', 'Not provided')}
-Species: {pet_details.get('species', 'Not provided')}
-Breed: {pet_details.get('breed', 'Not provided')}
-Age: {pet_details.get('age', 'Not provided')}
-Weight: {pet_details.get('weight', 'Not provided')}
-Sex: {pet_details.get('sex', 'Not provided')}
-Vaccination Status: {pet_details.get('vaccination_summary', 'Not provided')}
-Medical History: {pet_details.get('medical_history', 'Not provided')}
-"""
-
-        # Detect emergency
-        is_emergency = self.detect_emergency(query)
+        pet_summary = self._pet_summary(pet_details)
 
         # Create prompt
         prompt = f"""
@@ -269,33 +1045,119 @@ IMPORTANT:
 - Return ONLY valid JSON, no extra text
 """
 
-        try:
-            # Generate response
-            response = self.llm.generate_content(prompt)
+        return prompt
 
-            # Extract JSON
-            text = response.text
-            json_match = re.search(r'\{.*\}', text, re.DOTALL)
+    @staticmethod
+    def _pet_summary(pet_details: Dict[str, Any]) -> str:
+        """Pet details block used in the prompt (and hashed into the cache key)"""
+        return f"""
+Pet Name: {pet_details.get('name', 'Not provided')}
+Species: {pet_details.get('species', 'Not provided')}
+Breed: {pet_details.get('breed', 'Not provided')}
+Age: {pet_details.get('age', 'Not provided')}
+Weight: {pet_details.get('weight', 'Not provided')}
+Sex: {pet_details.get('sex', 'Not provided')}
+Vaccination Status: {pet_details.get('vaccination_summary', 'Not provided')}
+Medical History: {pet_details.get('medical_history', 'Not provided')}
+"""
 
-            if json_match:
-                result = json.loads(json_match.group())
-            else:
-                # Fallback if JSON parsing fails
-                result = self._create_fallback_response(pet_details, matched_entries, is_emergency)
+    @staticmethod
+    def _query_metadata(
+        matched_entries: List[Dict],
+        is_emergency: bool,
+        cache_hit: bool = False,
+        llm_bypassed: bool = False
+    ) -> Dict[str, Any]:
+        """Metadata attached to every response"""
+        return {
+            'timestamp': datetime.now().isoformat(),
+            'num_matches': len(matched_entries),
+            'is_emergency': is_emergency,
+            'top_match_score': matched_entries[0]['score'] if matched_entries else 0,
+            'cache_hit': cache_hit,
+            'llm_bypassed': llm_bypassed
+        }
 
-            # Add metadata
-            result['query_metadata'] = {
-                'timestamp': datetime.now().isoformat(),
-                'num_matches': len(matched_entries),
-                'is_emergency': is_emergency,
-                'top_match_score': matched_entries[0]['score'] if matched_entries else 0
-            }
+    def _create_emergency_response(
+        self,
+        pet_details: Dict,
+        matched_entries: List[Dict]
+    ) -> Dict:
+        """Static emergency response built from the top match (no LLM call)"""
+        result = self._create_fallback_response(pet_details, matched_entries, True)
+        result['immediate_steps'] = list(EMERGENCY_STEPS)
+        result['urgency_level'] = 'emergency'
+        result['service_recommendation'] = 'in_clinic'
+        result['query_metadata'] = self._query_metadata(matched_entries, True, llm_bypassed=True)
+        return result
+
+    def generate_response_stream(
+        self,
+        pet_details: Dict[str, Any],
+        query: str,
+        matched_entries: List[Dict]
+    ) -> Iterator[Dict[str, Any]]:
+        """Stream the response as events while Gemini produces it
+
+        Yields {'delta': text} for each LLM text chunk, then always ends with
+        {'done': True, 'data': result, 'query_metadata': ...}, where result is
+        the parsed LLM JSON, or the fallback if the LLM fails or returns
+        unparseable text. Emergencies and semantic cache hits send only the
+        final event.
+        """
+        is_emergency = self.detect_emergency(query)
 
-            return result
+        if is_emergency and matched_entries:
+            logger.info("   🚨 Emergency detected, skipping LLM call")
+            result = self._create_emergency_response(pet_details, matched_entries)
+            yield {'done': True, 'data': result, 'query_metadata': result.pop('query_metadata')}
+            return
+
+        prompt = self._build_prompt(pet_details, query, matched_entries, is_emergency)
+        result = None
+        cache_hit = False
+
+        try:
+            cache_vector, cache_scope = self._cache_key(pet_details, query, matched_entries)
+            result = self._cache_lookup(cache_vector, cache_scope)
+            cache_hit = result is not None
+
+            if cache_hit:
+                logger.info("   ♻️ Semantic cache hit, skipping LLM call")
+            else:
+                chunks = []
+                for chunk in self.llm.generate_content(
+                    prompt, stream=True, request_options=self._llm_request_options()
+                ):
+                    chunks.append(chunk.text)
+                    yield {'delta': chunk.text}
+
+                json_text = _extract_json(''.join(chunks))
+                if json_text:
+                    result = orjson.loads(json_text)
+                    self._cache_store(cache_vector, cache_scope, result)
 
         except Exception as e:
+            # Failures mid-stream still end with a usable (fallback) result
             logger.error(f"⚠️ LLM Error: {e}")
-            return self._create_fallback_response(pet_details, matched_entries, is_emergency)
+            result = None
+
+        if result is None:
+            result = self._create_fallback_response(pet_details, matched_entries, is_emergency)
+
+        yield {
+            'done': True,
+            'data': result,
+            'query_metadata': self._query_metadata(matched_entries, is_emergency, cache_hit=cache_hit)
+        }
+
+    @staticmethod
+    def _llm_request_options() -> Dict[str, Any]:
+        """Bound each Gemini call (retries included) so a stalled API can't pin a worker thread"""
+        return {
+            'timeout': LLM_TIMEOUT,
+            'retry': retry.Retry(predicate=retry.if_transient_error, timeout=LLM_TIMEOUT)
+        }
 
     def _create_fallback_response(
         self,
@@ -327,31 +1189,27 @@ IMPORTANT:
             }
 
         # Use top match
-        top = matched_entries[0]['metadata']
+        top = matched_entries[0]['index']
 
         return {
             "pet_name": pet_details.get('name', 'Your pet'),
-            "summary": f"Based on symptoms, this appears to be related to {top.get('symptom', 'the condition')}",
-            "what_we_found": top.get('description', ''),
+            "summary": f"Based on symptoms, this appears to be related to {self._field(top, 'symptom', 'the condition')}",
+            "what_we_found": self._field(top, 'description', ''),
             "immediate_steps": [
                 "Follow home care guidelines below",
                 "Monitor symptoms closely",
                 "Note any worsening"
             ],
-            "home_care_tips": [top.get('home_care_india', 'Keep comfortable and monitor')],
-            "when_to_see_vet": top.get('vet_triggers', 'If symptoms persist or worsen'),
-            "urgency_level": top.get('severity', 'routine'),
-            "service_recommendation": top.get('service_recommendation', 'video_consult'),
+            "home_care_tips": [self._field(top, 'home_care_india', 'Keep comfortable and monitor')],
+            "when_to_see_vet": self._field(top, 'vet_triggers', 'If symptoms persist or worsen'),
+            "urgency_level": self._field(top, 'severity', 'routine'),
+            "service_recommendation": self._field(top, 'service_recommendation', 'video_consult'),
             "confidence": "medium",
-            "additional_notes": top.get('indian_climate_factors', '')
+            "additional_notes": self._field(top, 'indian_climate_factors', '')
         }
 
-    def process_query(
-        self,
-        pet_details: Dict[str, Any],
-        query: str
-    ) -> Dict[str, Any]:
-        """Main function: Process pet details + query → Return response"""
+    def _find_matches(self, pet_details: Dict[str, Any], query: str) -> List[Dict]:
+        """Search entries for the query, filtered to the pet's species"""
 
         # Extract species for filtering
         species = pet_details.get('species', '').lower()
@@ -366,6 +1224,16 @@ IMPORTANT:
         logger.info(f"🔍 Searching for: {query[:50]}...")
         matches = self.search(query, species=species)
         logger.info(f"   Found {len(matches)} relevant entries")
+        return matches
+
+    def process_query(
+        self,
+        pet_details: Dict[str, Any],
+        query: str
+    ) -> Dict[str, Any]:
+        """Main function: Process pet details + query → Return response"""
+
+        matches = self._find_matches(pet_details, query)
 
         # Generate response
         logger.info(f"💬 Generating response...")
@@ -373,3 +1241,17 @@ IMPORTANT:
         logger.info(f"   ✅ Response ready")
 
         return response
+
+    def process_query_stream(
+        self,
+        pet_details: Dict[str, Any],
+        query: str
+    ) -> Iterator[Dict[str, Any]]:
+        """Streaming variant of process_query: searches now, returns the response event stream
+
+        Not a generator itself, so search errors raise before any response is sent."""
+
+        matches = self._find_matches(pet_details, query)
+
+        logger.info("💬 Streaming response...")
+        return self.generate_response_stream(pet_details, query, matches)
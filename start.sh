@@ -1,2 +1,2 @@
 #!/bin/bash
-exec gunicorn app:app --bind 0.0.0.0:$PORT
+exec gunicorn wsgi:app --bind 0.0.0.0:$PORT --workers ${WEB_CONCURRENCY:-2} --worker-class gthread --threads 8 --preload --timeout 60
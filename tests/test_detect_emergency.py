@@ -0,0 +1,39 @@
+"""
+Emergency detection must only fire on whole-word, non-negated keywords
+(a hit bypasses the LLM with a static emergency answer)
+"""
+
+import pytest
+
+from rag_system import SnoutiqRAG, EMERGENCY_KEYWORDS
+
+
+@pytest.fixture(scope="module")
+def rag():
+    # detect_emergency only needs the keyword automaton, not models or the LLM
+    rag = object.__new__(SnoutiqRAG)
+    rag.emergency_automaton = SnoutiqRAG._build_automaton(EMERGENCY_KEYWORDS)
+    return rag
+
+
+@pytest.mark.parametrize("query", [
+    "my bloodhound keeps scratching his ears",
+    "bloodwork came back normal, mild itching",
+    "he is not bleeding anymore, just limping",
+    "no blood in the stool, just loose motion",
+    "my cat has been vomiting since morning",
+])
+def test_not_emergency(rag, query):
+    assert not rag.detect_emergency(query)
+
+
+@pytest.mark.parametrize("query", [
+    "my dog is bleeding heavily from his leg",
+    "there is blood in her vomit",
+    "Seizure started 5 minutes ago!",
+    "he is not breathing properly",
+    "my dog can't stand up after the fall",
+    "not bleeding anymore but he collapsed",
+])
+def test_emergency(rag, query):
+    assert rag.detect_emergency(query)
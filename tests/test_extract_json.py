@@ -0,0 +1,38 @@
+"""
+_extract_json returns the first balanced {...} object from LLM output
+"""
+
+import orjson
+import pytest
+
+from rag_system import _extract_json
+
+FENCED = '''Here is the assessment:
+```json
+{
+  "summary": "Mild upset stomach",
+  "immediate_steps": ["Withhold food for a few hours"]
+}
+```
+Hope this helps {not json}'''
+
+
+@pytest.mark.parametrize("text, expected", [
+    ('{"a": 1}', '{"a": 1}'),
+    ('{"a": "}"} trailing {x}', '{"a": "}"}'),
+    ('{"a": "{"} and more', '{"a": "{"}'),
+    ('{"a": "say \\"hi\\" }"}', '{"a": "say \\"hi\\" }"}'),
+    ('{"a": "back\\\\"} {"b": 2}', '{"a": "back\\\\"}'),
+    ('Sure! {"a": {"b": [1, {"c": 2}]}} done', '{"a": {"b": [1, {"c": 2}]}}'),
+    (FENCED, FENCED[FENCED.index('{'):FENCED.index('}\n```') + 1]),
+    ('{"a": {"b": 1}', None),
+    ('{"a": "}', None),
+    ('no json here', None),
+    ('', None),
+])
+def test_extract_json(text, expected):
+    assert _extract_json(text) == expected
+
+
+def test_fenced_block_parses():
+    assert orjson.loads(_extract_json(FENCED))['summary'] == "Mild upset stomach"
@@ -0,0 +1,126 @@
+"""
+Semantic LLM cache: eviction and merging of per-process cache files
+"""
+
+import os
+import pickle
+import threading
+
+import faiss
+import numpy as np
+import pytest
+
+import rag_system
+from rag_system import SnoutiqRAG
+
+DIM = 4
+
+
+def unit(*components):
+    vector = np.asarray(components, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def entry(vector, scope, created, answer):
+    return {'scope': scope, 'vector': vector, 'created': created, 'result': {'summary': answer}}
+
+
+def write(path, entries):
+    with open(path, 'wb') as f:
+        pickle.dump(entries, f)
+
+
+@pytest.fixture
+def rag():
+    # The cache only needs its index and bookkeeping, not models or the LLM
+    rag = object.__new__(SnoutiqRAG)
+    rag.cache_index = faiss.IndexFlatIP(DIM)
+    rag.cache_entries = []
+    rag._cache_dirty = False
+    rag._cache_lock = threading.Lock()
+    return rag
+
+
+@pytest.fixture
+def cache_path(tmp_path):
+    return str(tmp_path / "llm_cache_sig")
+
+
+def test_lookup_is_scoped(rag):
+    vector = unit(1, 0, 0, 0)[None, :]
+    rag._cache_store(vector, ('pet-a', 3), {'summary': 'a'})
+
+    assert rag._cache_lookup(vector, ('pet-a', 3)) == {'summary': 'a'}
+    assert rag._cache_lookup(vector, ('pet-b', 3)) is None
+    assert rag._cache_lookup(unit(0, 1, 0, 0)[None, :], ('pet-a', 3)) is None
+
+
+def test_store_evicts_oldest_tenth(rag, monkeypatch):
+    monkeypatch.setattr(rag_system, "LLM_CACHE_MAX_ENTRIES", 10)
+    vectors = [unit(1, i, 0, 0) for i in range(11)]
+    for i, vector in enumerate(vectors):
+        rag._cache_store(vector[None, :], ('pet', i), {'summary': str(i)})
+
+    assert [e['scope'][1] for e in rag.cache_entries] == list(range(2, 11))
+    assert rag.cache_index.ntotal == 9
+    assert rag._cache_lookup(vectors[10][None, :], ('pet', 10)) == {'summary': '10'}
+    assert rag._cache_lookup(vectors[0][None, :], ('pet', 0)) is None
+
+
+def test_save_writes_per_process_file_only_when_dirty(rag, cache_path):
+    rag.save_cache(cache_path)
+    assert not os.listdir(os.path.dirname(cache_path))
+
+    rag._cache_store(unit(1, 0, 0, 0)[None, :], ('pet', 1), {'summary': 'a'})
+    rag.save_cache(cache_path)
+    assert os.listdir(os.path.dirname(cache_path)) == [f"llm_cache_sig.{os.getpid()}.pkl"]
+
+
+def test_load_merges_keeps_newest_and_folds_files(rag, cache_path):
+    shared, other = unit(1, 0, 0, 0), unit(0, 1, 0, 0)
+    write(f"{cache_path}.pkl", [entry(shared, ('pet', 1), 1.0, 'old'), entry(other, ('pet', 2), 2.0, 'other')])
+    write(f"{cache_path}.101.pkl", [entry(shared, ('pet', 1), 5.0, 'newest')])
+    write(f"{cache_path}.102.pkl", [
+        entry(shared, ('pet', 1), 3.0, 'stale'),
+        entry(shared, ('other pet', 1), 4.0, 'other scope'),
+        entry(np.ones(DIM + 1, dtype=np.float32), ('pet', 3), 6.0, 'wrong dimension'),
+    ])
+
+    rag.load_cache(cache_path)
+
+    assert [e['result']['summary'] for e in rag.cache_entries] == ['other', 'other scope', 'newest']
+    assert rag.cache_index.ntotal == 3
+    assert rag._cache_lookup(shared[None, :], ('pet', 1)) == {'summary': 'newest'}
+    assert not rag._cache_dirty
+
+    # Per-process files are folded into the shared file and removed
+    assert os.listdir(os.path.dirname(cache_path)) == ["llm_cache_sig.pkl"]
+    with open(f"{cache_path}.pkl", 'rb') as f:
+        assert [e['result']['summary'] for e in pickle.load(f)] == ['other', 'other scope', 'newest']
+
+
+def test_load_caps_to_newest_entries(rag, cache_path, monkeypatch):
+    monkeypatch.setattr(rag_system, "LLM_CACHE_MAX_ENTRIES", 3)
+    write(f"{cache_path}.101.pkl", [
+        entry(unit(1, i, 0, 0), ('pet', i), float(i), str(i)) for i in range(5)
+    ])
+
+    rag.load_cache(cache_path)
+
+    assert [e['result']['summary'] for e in rag.cache_entries] == ['2', '3', '4']
+    assert rag.cache_index.ntotal == 3
+
+
+def test_load_ignores_unreadable_file(rag, cache_path):
+    write(f"{cache_path}.101.pkl", [entry(unit(1, 0, 0, 0), ('pet', 1), 1.0, 'ok')])
+    with open(f"{cache_path}.102.pkl", 'wb') as f:
+        f.write(b"not a pickle")
+
+    rag.load_cache(cache_path)
+
+    assert [e['result']['summary'] for e in rag.cache_entries] == ['ok']
+
+
+def test_load_without_files_is_noop(rag, cache_path):
+    rag.load_cache(cache_path)
+    assert rag.cache_entries == [] and rag.cache_index.ntotal == 0
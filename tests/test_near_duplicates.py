@@ -0,0 +1,59 @@
+"""
+Near-duplicate pruning keeps one entry per same-species cluster above NEAR_DUPLICATE_THRESHOLD
+"""
+
+import numpy as np
+
+import rag_system
+from rag_system import SnoutiqRAG
+
+DOG, CAT = rag_system.SPECIES_IDS['dogs'], rag_system.SPECIES_IDS['cats']
+
+
+def unit(*components):
+    vector = np.asarray(components, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+BASE = unit(1, 0, 0, 0)
+NEAR_BASE = unit(1, 0.12, 0, 0)  # cosine ~0.993 with BASE
+OTHER = unit(0, 0, 1, 0)
+
+
+def mask(vectors, species_ids, severities):
+    return list(SnoutiqRAG._near_duplicate_mask(np.stack(vectors), species_ids, severities))
+
+
+def test_cross_species_twin_does_not_hide_same_species_duplicate():
+    # Two cat twins rank above the dog near-duplicate; they must be skipped, not stop the search
+    keep = mask(
+        [BASE, BASE, BASE, NEAR_BASE, OTHER],
+        [DOG, CAT, CAT, DOG, DOG],
+        ['routine', 'routine', 'routine', 'routine', 'routine']
+    )
+    assert keep == [True, True, False, False, True]
+
+
+def test_cross_species_pair_is_kept():
+    assert mask([BASE, BASE], [DOG, CAT], ['routine', 'routine']) == [True, True]
+
+
+def test_more_severe_entry_wins():
+    keep = mask([BASE, NEAR_BASE], [DOG, DOG], ['routine', 'emergency'])
+    assert keep == [False, True]
+
+
+def test_tie_keeps_earlier_entry():
+    keep = mask([NEAR_BASE, BASE], [CAT, CAT], ['urgent', 'urgent'])
+    assert keep == [True, False]
+
+
+def test_dissimilar_entries_are_kept():
+    keep = mask([BASE, unit(1, 1, 0, 0)], [DOG, DOG], ['routine', 'routine'])
+    assert keep == [True, True]
+
+
+def test_skipped_above_max_entries(monkeypatch):
+    monkeypatch.setattr(rag_system, "NEAR_DUPLICATE_MAX_ENTRIES", 2)
+    keep = mask([BASE, BASE, BASE], [DOG, DOG, DOG], ['routine', 'routine', 'routine'])
+    assert keep == [True, True, True]
@@ -0,0 +1,78 @@
+"""
+Numba and NumPy ranking kernels must select and order candidates identically
+"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip("numba")
+
+import rag_system
+from rag_system import _rank_candidates_numpy
+
+if rag_system.rank_candidates is _rank_candidates_numpy:
+    pytest.skip("Numba kernel unavailable, ranking uses NumPy", allow_module_level=True)
+
+SPECIES_IDS = np.array([0, 1, 0, 2, 0, 1, 0, 0], dtype=np.int8)
+BOOST = np.array([1.0, 1.5, 1.2, 1.0, 1.5, 1.0, 1.0, 1.2], dtype=np.float32)
+
+
+def rank_both(indices, scores, wanted_species=-1, min_similarity=0.3, top_k=10):
+    """Run both kernels on the same inputs"""
+    indices = np.asarray(indices, dtype=np.int64)
+    scores = np.asarray(scores, dtype=np.float32)
+    args = (indices, scores, SPECIES_IDS, BOOST, wanted_species, min_similarity, top_k)
+    return rag_system.rank_candidates(*args), _rank_candidates_numpy(*args)
+
+
+def assert_same(numba_result, numpy_result):
+    np.testing.assert_array_equal(numba_result[0], numpy_result[0])
+    np.testing.assert_array_equal(numba_result[1], numpy_result[1])
+    assert numba_result[0].dtype == numpy_result[0].dtype == np.int64
+    assert numba_result[1].dtype == numpy_result[1].dtype == np.float32
+
+
+def test_order_and_threshold():
+    numba_result, numpy_result = rank_both(
+        [0, 1, 2, 3, 4, 5, 6, 7], [0.9, 0.8, 0.7, 0.6, 0.5, 0.4, 0.2, 0.1]
+    )
+    assert_same(numba_result, numpy_result)
+    assert list(numba_result[0]) == [1, 0, 2, 4, 3, 5]
+
+
+def test_ties_keep_candidate_order():
+    # 0.5 * 1.2 == 0.6 * 1.0 and equal raw scores: stable order by search rank
+    numba_result, numpy_result = rank_both([7, 6, 3, 2], [0.5, 0.6, 0.6, 0.5])
+    assert_same(numba_result, numpy_result)
+    assert list(numba_result[0]) == [7, 6, 3, 2]
+
+
+def test_species_filter():
+    numba_result, numpy_result = rank_both(
+        [0, 1, 2, 3, 4, 5], [0.9, 0.9, 0.8, 0.8, 0.7, 0.7], wanted_species=1
+    )
+    assert_same(numba_result, numpy_result)
+    assert list(numba_result[0]) == [1, 5]
+
+
+def test_top_k():
+    numba_result, numpy_result = rank_both(
+        [0, 1, 2, 3, 4, 5], [0.9, 0.8, 0.7, 0.6, 0.5, 0.4], top_k=2
+    )
+    assert_same(numba_result, numpy_result)
+    assert len(numba_result[0]) == 2
+
+
+@pytest.mark.parametrize("indices, scores", [([], []), ([0, 1], [0.1, 0.2])])
+def test_empty(indices, scores):
+    numba_result, numpy_result = rank_both(indices, scores)
+    assert_same(numba_result, numpy_result)
+    assert len(numba_result[0]) == 0
+
+
+def test_unwritable_cache_falls_back_to_numpy(monkeypatch):
+    def njit(**options):
+        raise RuntimeError("cannot cache function: no locator available")
+
+    monkeypatch.setattr(rag_system, "njit", njit)
+    assert rag_system._compile_rank_candidates() is _rank_candidates_numpy
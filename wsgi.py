@@ -0,0 +1,27 @@
+"""
+SNOUTIQ WSGI Entry Point
+Run with: gunicorn --worker-class gthread --threads 8 --preload wsgi:app
+(worker hooks are picked up from gunicorn.conf.py)
+"""
+
+import logging
+
+from app import app, initialize_rag_system, configure_threads
+
+logger = logging.getLogger(__name__)
+
+# Build the RAG system at import time so `--preload` loads the datasets and the
+# FAISS index once in the gunicorn master and workers share it after fork.
+# Build single-threaded: an OpenMP pool started in the master is unusable (and
+# can deadlock) in forked workers, which start their own after the fork.
+configure_threads(1)
+try:
+    initialize_rag_system()
+    logger.info("✅ RAG System initialization complete")
+except Exception as e:
+    logger.error(f"❌ Failed to initialize RAG system: {str(e)}", exc_info=True)
+    # Don't exit - let the server start so we can see health endpoint
+finally:
+    configure_threads()
+
+__all__ = ['app']